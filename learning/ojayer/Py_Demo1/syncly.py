@@ -1,13 +1,27 @@
 import os
 import io
+import re
 import json
+import time
+import heapq
+import shutil
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import googleapiclient
 from googleapiclient.discovery import build
 from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.http import MediaFileUpload, MediaIoBaseDownload
+from googleapiclient.http import MediaFileUpload, MediaIoBaseUpload, MediaIoBaseDownload
 from google.oauth2.credentials import Credentials
+from google.auth.transport.requests import Request
+from google.auth.exceptions import RefreshError
 from dotenv import load_dotenv
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # Load environment variables
 load_dotenv()
 
@@ -17,31 +31,96 @@ SCOPES = ['https://www.googleapis.com/auth/drive']
 # Get paths from environment
 TOKEN_DIR = os.getenv("TOKEN_DIR", "tokens")
 CREDENTIALS_FILE = os.getenv("CREDENTIALS_FILE", "credentials.json")
-METADATA_FILE = "metadata.json"
+METADATA_FILE = "metadata.jsonl"
+LEGACY_METADATA_FILE = "metadata.json"
+METADATA_INDEX_FILE = "metadata_index.json"
+MAX_WORKERS = 32
+MIB = 1 << 20
+GIB = 1 << 30
+SIMPLE_UPLOAD_LIMIT = 5 * MIB
+SINGLE_REQUEST_LIMIT = 256 * MIB
+UPLOAD_CHUNK_SIZE = 16 * MIB
+QUOTA_TTL = 60
 os.makedirs(TOKEN_DIR, exist_ok=True)
 
-def authenticate_account(bucket_number):
+# Drive services are built once per bucket and shared across threads
+_SERVICE_CACHE = {}
+_SERVICE_LOCKS = {}
+_SERVICE_LOCK = threading.Lock()
+# Only one interactive sign-in at a time, so the user always knows which bucket a browser tab is for
+_OAUTH_LOCK = threading.Lock()
+
+def build_drive(creds):
+    # static_discovery reads the Drive v3 document bundled with the client library, so no HTTP fetch
+    return build("drive", "v3", credentials=creds, cache_discovery=False, static_discovery=True)
+
+def build_service(bucket_number):
     token_path = os.path.join(TOKEN_DIR, f"bucket_{bucket_number}.json")
     if os.path.exists(token_path):
         creds = Credentials.from_authorized_user_file(token_path, SCOPES)
+        # Access tokens last an hour; refresh them so the browser only opens when there is no usable token
+        if creds.expired and creds.refresh_token:
+            try:
+                creds.refresh(Request())
+                with open(token_path, "w") as token_file:
+                    token_file.write(creds.to_json())
+            except RefreshError as e:
+                print(f"Could not refresh token for bucket {bucket_number}: {e}")
         if creds.valid:
-            return build("drive", "v3", credentials=creds)
-    flow = InstalledAppFlow.from_client_secrets_file(CREDENTIALS_FILE, SCOPES)
-    creds = flow.run_local_server(port=0)
-    with open(token_path, "w") as token_file:
-        token_file.write(creds.to_json())
-    return build("drive", "v3", credentials=creds)
-
-def list_drive_files(service, max_results=None, query=None):
+            return build_drive(creds)
+    with _OAUTH_LOCK:
+        print(f"Sign in to the Google account for bucket {bucket_number} in the browser window.")
+        flow = InstalledAppFlow.from_client_secrets_file(CREDENTIALS_FILE, SCOPES)
+        creds = flow.run_local_server(port=0)
+        with open(token_path, "w") as token_file:
+            token_file.write(creds.to_json())
+    return build_drive(creds)
+
+def authenticate_account(bucket_number):
+    key = str(bucket_number)
+    # The global lock only guards the dicts; each bucket builds under its own lock so different
+    # buckets load tokens in parallel, while build_service serializes any browser sign-in
+    with _SERVICE_LOCK:
+        if key in _SERVICE_CACHE:
+            return _SERVICE_CACHE[key]
+        bucket_lock = _SERVICE_LOCKS.setdefault(key, threading.Lock())
+    with bucket_lock:
+        with _SERVICE_LOCK:
+            service = _SERVICE_CACHE.get(key)
+        if service is None:
+            service = build_service(key)
+            with _SERVICE_LOCK:
+                _SERVICE_CACHE[key] = service
+        return service
+
+def escape_query(value):
+    # Drive query strings are single-quoted; escape backslashes and quotes in user input
+    return value.replace("\\", "\\\\").replace("'", "\\'")
+
+def list_drive_files(service, max_results=None, query=None, fields_extra=(), trashed=False, exclude_folders=True):
     all_files = []
     page_token = None
-    query_filter = f"name contains '{query}'" if query else None
+    # Let Drive do the filtering and sorting instead of the client
+    clauses = []
+    if not trashed:
+        clauses.append("trashed=false")
+    if exclude_folders:
+        clauses.append("mimeType!='application/vnd.google-apps.folder'")
+    if query:
+        clauses.append(f"name contains '{escape_query(query)}'")
+    query_filter = " and ".join(clauses) or None
+    # Only ask Drive for size when the caller shows it
+    fields = f"nextPageToken, files(id, name, mimeType{', size' if 'size' in fields_extra else ''})"
     while True:
+        page_size = 1000
+        if max_results:
+            page_size = min(page_size, max_results - len(all_files))
         results = service.files().list(
-            pageSize=100,
-            fields="nextPageToken, files(id, name, mimeType, size)",
+            pageSize=page_size,
+            fields=fields,
             pageToken=page_token,
-            q=query_filter
+            q=query_filter,
+            orderBy="name"
         ).execute()
         all_files.extend(results.get('files', []))
         if max_results and len(all_files) >= max_results:
@@ -51,8 +130,18 @@ def list_drive_files(service, max_results=None, query=None):
             break
     return all_files
 
+# (TOKEN_DIR mtime, bucket list); adding or removing a token file changes the directory mtime
+_BUCKETS_CACHE = (None, [])
+
 def get_all_authenticated_buckets():
-    return [f.replace(".json", "").replace("bucket_", "") for f in os.listdir(TOKEN_DIR) if f.startswith("bucket_")]
+    global _BUCKETS_CACHE
+    mtime = os.stat(TOKEN_DIR).st_mtime_ns
+    if _BUCKETS_CACHE[0] != mtime:
+        with os.scandir(TOKEN_DIR) as entries:
+            buckets = [entry.name[len("bucket_"):-len(".json")] for entry in entries
+                       if entry.name.startswith("bucket_") and entry.name.endswith(".json")]
+        _BUCKETS_CACHE = (mtime, buckets)
+    return list(_BUCKETS_CACHE[1])
 
 def check_storage(service, bucket):
     try:
@@ -64,165 +153,370 @@ def check_storage(service, bucket):
         print(f"Error for {bucket}: {e}")
         return 0, 0
 
+def bucket_pool(buckets):
+    return ThreadPoolExecutor(max_workers=max(1, min(MAX_WORKERS, len(buckets))))
+
+# bucket -> (limit, usage, fetched_at); kept current locally by our own uploads
+_QUOTA_CACHE = {}
+_QUOTA_LOCK = threading.Lock()
+
+def refresh_quota(bucket):
+    limit, usage = check_storage(authenticate_account(bucket), bucket)
+    if limit:
+        with _QUOTA_LOCK:
+            _QUOTA_CACHE[bucket] = (limit, usage, time.monotonic())
+    return limit, usage
+
+def cached_quota(bucket):
+    with _QUOTA_LOCK:
+        entry = _QUOTA_CACHE.get(bucket)
+    if entry and time.monotonic() - entry[2] < QUOTA_TTL:
+        return entry[0], entry[1]
+    return refresh_quota(bucket)
+
+def record_usage(bucket, size):
+    with _QUOTA_LOCK:
+        if bucket in _QUOTA_CACHE:
+            limit, usage, fetched_at = _QUOTA_CACHE[bucket]
+            _QUOTA_CACHE[bucket] = (limit, usage + size, fetched_at)
+
+def check_storage_for_buckets(buckets, cached=False):
+    # Drive calls are network bound, so query every bucket at once
+    fetch = cached_quota if cached else refresh_quota
+    with bucket_pool(buckets) as pool:
+        return list(pool.map(lambda b: (b, fetch(b)), buckets))
+
+def to_gib(size):
+    return round(size / GIB, 2)
+
 def check_all_storage():
-    total_storage = 0
-    total_used = 0
     buckets = get_all_authenticated_buckets()
     if not buckets:
         print("No authenticated buckets found.")
         return
-    for bucket in buckets:
-        service = authenticate_account(bucket)
-        storage, used = check_storage(service, bucket)
-        total_storage += storage
+    total_storage = 0
+    total_used = 0
+    for _, (limit, used) in check_storage_for_buckets(buckets):
+        total_storage += limit
         total_used += used
-    print(f"Total Storage: {round(total_storage / (1024**3), 2)} GB")
-    print(f"Total Used: {round(total_used / (1024**3), 2)} GB")
-    print(f"Total Free: {round((total_storage - total_used) / (1024**3), 2)} GB")
+    print(f"Total Storage: {to_gib(total_storage)} GB")
+    print(f"Total Used: {to_gib(total_used)} GB")
+    print(f"Total Free: {to_gib(total_storage - total_used)} GB")
 
-def list_files_from_all_buckets(query=None):
+def list_files_from_all_buckets(query=None, fields_extra=("size",)):
     bucket_numbers = get_all_authenticated_buckets()
     if not bucket_numbers:
         print("No authenticated buckets found.")
         return
-    all_files = []
-    for bucket in bucket_numbers:
-        try:
-            service = authenticate_account(bucket)
-            files = list_drive_files(service, None, query)
-            for file in files:
-                all_files.append((file['name'], file['id'], file.get('mimeType', 'Unknown'), file.get('size', 'Unknown')))
-        except Exception as e:
-            print(f"Error retrieving files for bucket {bucket}: {e}")
-    all_files.sort(key=lambda x: x[0])
+    per_bucket_files = []
+    with bucket_pool(bucket_numbers) as pool:
+        futures = {pool.submit(lambda b: list_drive_files(authenticate_account(b), None, query, fields_extra), bucket): bucket
+                   for bucket in bucket_numbers}
+        for future in as_completed(futures):
+            try:
+                files = [(file['name'], file['id'], file.get('mimeType', 'Unknown'), file.get('size', 'Unknown'))
+                         for file in future.result()]
+                # Drive's name collation may differ from Python's, and heapq.merge needs both to agree
+                files.sort(key=lambda x: x[0])
+                per_bucket_files.append(files)
+            except Exception as e:
+                print(f"Error retrieving files for bucket {futures[future]}: {e}")
+    # Merge the sorted bucket lists lazily, one page at a time
+    all_files = heapq.merge(*per_bucket_files, key=lambda x: x[0])
     page_size = 30
     start_index = 0
-    total_files = len(all_files)
-    while start_index < total_files:
+    page = list(itertools.islice(all_files, page_size))
+    while page:
         print("\nFiles (Sorted Alphabetically):\n")
-        for idx, (name, file_id, mime_type, size) in enumerate(all_files[start_index:start_index+page_size], start=start_index+1):
-            size_str = f"{float(size)/1024**2:.2f} MB" if size != 'Unknown' else "Unknown size"
+        for idx, (name, file_id, mime_type, size) in enumerate(page, start=start_index+1):
+            if 'size' not in fields_extra:
+                print(f"{idx}. {name} ({mime_type})")
+                continue
+            size_str = f"{int(size) / MIB:.2f} MB" if size != 'Unknown' else "Unknown size"
             print(f"{idx}. {name} ({mime_type}) - {size_str}")
         start_index += page_size
-        if start_index < total_files:
+        page = list(itertools.islice(all_files, page_size))
+        if page:
             more = input("\nSee more files? (y/n): ").strip().lower()
             if more != 'y':
                 break
 
-def upload_chunk(service, chunk_path, mimetype, file_name, chunk_index):
-    media = MediaFileUpload(chunk_path, mimetype=mimetype, resumable=True)
+def upload_options(size, bounded=False):
+    # Small bodies skip the resumable handshake; mid-sized ones go in one request (-1) with no per-chunk acks.
+    # bounded uploads always send UPLOAD_CHUNK_SIZE pieces so memory per upload stays fixed.
+    if size < SIMPLE_UPLOAD_LIMIT:
+        return {"resumable": False, "chunksize": -1}
+    if size <= SINGLE_REQUEST_LIMIT and not bounded:
+        return {"resumable": True, "chunksize": -1}
+    return {"resumable": True, "chunksize": UPLOAD_CHUNK_SIZE}
+
+class FileSlice(io.RawIOBase):
+    # Read-only, seekable view of bytes [offset, offset + size) of a file.
+    # Reads go through the shared fd with os.pread; where that is missing (Windows) fd is None
+    # and the slice reads through its own file object instead.
+    def __init__(self, file_path, fd, offset, size):
+        super().__init__()
+        self.fd = fd
+        self.file = open(file_path, "rb") if fd is None else None
+        self.start = offset
+        self.size = size
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, pos, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            pos += self.pos
+        elif whence == io.SEEK_END:
+            pos += self.size
+        self.pos = max(0, min(pos, self.size))
+        return self.pos
+
+    def readinto(self, buffer):
+        size = min(len(buffer), self.size - self.pos)
+        if size <= 0:
+            return 0
+        if self.file:
+            self.file.seek(self.start + self.pos)
+            data = self.file.read(size)
+        else:
+            data = read_at(self.fd, size, self.start + self.pos)
+        buffer[:len(data)] = data
+        self.pos += len(data)
+        return len(data)
+
+    def close(self):
+        if self.file:
+            self.file.close()
+        super().close()
+
+def upload_chunk(service, stream, size, mimetype, file_name, chunk_index, cancel):
+    media = MediaIoBaseUpload(stream, mimetype=mimetype, **upload_options(size, bounded=True))
     file_metadata = {'name': f'{file_name}_part{chunk_index + 1}'}
-    result = service.files().create(media_body=media, body=file_metadata).execute()
+    request = service.files().create(media_body=media, body=file_metadata)
+    if not media.resumable():
+        return request.execute().get("id")
+    # Send one piece at a time so a failed sibling chunk can stop this upload early
+    result = None
+    while result is None:
+        if cancel.is_set():
+            raise RuntimeError("Upload cancelled")
+        _, result = request.next_chunk()
     return result.get("id")
 
+def plan_chunks(heap, file_size):
+    # First-fit-decreasing over a max-heap of (-free, bucket) so the file needs as few chunks as possible
+    plan = []
+    offset = 0
+    while offset < file_size and heap:
+        neg_free, bucket = heapq.heappop(heap)
+        chunk_size = min(-neg_free, file_size - offset)
+        plan.append((offset, chunk_size, bucket))
+        offset += chunk_size
+        if -neg_free > chunk_size:
+            heapq.heappush(heap, (neg_free + chunk_size, bucket))
+    return plan
+
+def read_at(fd, size, offset):
+    # os.pread never moves the shared file offset, so upload threads can read one fd without a lock.
+    # A single call may return less than asked (Linux caps reads near 2 GiB), hence the loop.
+    parts = []
+    while size > 0:
+        data = os.pread(fd, size, offset)
+        if not data:
+            break
+        parts.append(data)
+        size -= len(data)
+        offset += len(data)
+    return b"".join(parts)
+
+def upload_planned_chunk(file_path, fd, offset, chunk_size, bucket, mimetype, file_name, chunk_index, cancel):
+    service = authenticate_account(bucket)
+    try:
+        with FileSlice(file_path, fd, offset, chunk_size) as stream:
+            file_id = upload_chunk(service, stream, chunk_size, mimetype, file_name, chunk_index, cancel)
+    except googleapiclient.errors.HttpError as e:
+        if "storageQuotaExceeded" in str(e):
+            print(f"Bucket {bucket} is full.")
+            refresh_quota(bucket)
+        raise
+    record_usage(bucket, chunk_size)
+    return file_id
+
 def upload_file(file_path, file_name, mimetype):
     file_size = os.path.getsize(file_path)
     buckets = get_all_authenticated_buckets()
     free_space = []
     total_free = 0
 
-    for bucket in buckets:
-        service = authenticate_account(bucket)
-        total, used = check_storage(service, bucket)
+    for bucket, (total, used) in check_storage_for_buckets(buckets, cached=True):
         free = total - used
         total_free += free
         if free > 0:
-            free_space.append([free, bucket])
+            free_space.append((-free, bucket))
 
     if total_free < file_size:
         print("Not enough space.")
         return
 
-    free_space.sort(reverse=False, key=lambda x: x[0])
-    print(free_space)
+    heapq.heapify(free_space)
     metadata = {"file_name": file_name, "chunks": []}
     best_bucket = free_space[0][1]
-    service = authenticate_account(best_bucket)
 
-    if free_space[0][0] >= file_size:
-        media = MediaFileUpload(file_path, mimetype=mimetype, resumable=True)
+    if -free_space[0][0] >= file_size:
+        service = authenticate_account(best_bucket)
+        media = MediaFileUpload(file_path, mimetype=mimetype, **upload_options(file_size))
         file_metadata = {'name': file_name}
-        result = service.files().create(media_body=media, body=file_metadata).execute()
+        try:
+            result = service.files().create(media_body=media, body=file_metadata).execute()
+        except googleapiclient.errors.HttpError as e:
+            # The cached quota was stale; refresh it so the next upload doesn't pick this bucket again
+            if "storageQuotaExceeded" in str(e):
+                print(f"Bucket {best_bucket} is full.")
+                refresh_quota(best_bucket)
+            raise
         file_id = result.get("id")
+        record_usage(best_bucket, file_size)
         metadata["chunks"].append({"chunk_name": file_name, "file_id": file_id, "bucket": best_bucket})
     else:
-        offset = 0
-        chunk_index = 0
-        with open(file_path, "rb") as file:
-            while offset < file_size:
-                # Sort and get the best available bucket
-                free_space.sort(reverse=False, key=lambda x: x[0])
-                print(free_space)
-
-                # Find a bucket with enough space
-                selected_bucket = None
-                for i, (bucket_free, bucket_id) in enumerate(free_space):
-                    if bucket_free > 0:
-                        selected_bucket = bucket_id
-                        selected_index = i
-                        break
-
-                if not selected_bucket:
-                    print("No available buckets with free space.")
-                    break
-
-                chunk_size = min(free_space[selected_index][0], file_size - offset)
-                chunk_filename = f"{file_path}.part{chunk_index}"
-
-                with open(chunk_filename, "wb") as chunk_file:
-                    chunk_file.write(file.read(chunk_size))
-
-                file_id = None
-                uploaded = False
-                while not uploaded:
-                    service = authenticate_account(selected_bucket)
-                    try:
-                        file_id = upload_chunk(service, chunk_filename, mimetype, file_name, chunk_index)
-                        uploaded = True
-                    except googleapiclient.errors.HttpError as e:
-                        if "storageQuotaExceeded" in str(e):
-                            print(f"Bucket {selected_bucket} is full. Trying next bucket.")
-                            free_space[selected_index][0] = 0  # Mark bucket as full
-                            break
-                        else:
-                            os.remove(chunk_filename)
-                            raise e
-
-                if file_id is None:
-                    raise RuntimeError("Failed to upload chunk after retries")
-
-                metadata["chunks"].append({
-                    "chunk_name": f"{file_name}_part{chunk_index + 1}",
-                    "file_id": file_id,
-                    "bucket": selected_bucket
-                })
-
-                # Update remaining space after successful upload
-                free_space[selected_index][0] -= chunk_size
-                offset += chunk_size
-                chunk_index += 1
-                os.remove(chunk_filename)
-
-    # Update metadata
-    if os.path.exists(METADATA_FILE) and os.path.getsize(METADATA_FILE) > 0:
-        with open(METADATA_FILE, 'r') as f:
-            try:
-                existing_metadata = json.load(f)
-                if not isinstance(existing_metadata, list):  
-                    existing_metadata = [existing_metadata]
-            except json.JSONDecodeError:
-                print("Warning: Metadata file is corrupted. Resetting metadata.")
-                existing_metadata = []
-    else:
-        existing_metadata = []
-
-    existing_metadata.append(metadata)
-
-    with open(METADATA_FILE, 'w') as f:
-        json.dump(existing_metadata, f, indent=4)
-        print("Upload complete. Metadata updated.")
-
-
+        # Every planned chunk goes to a different bucket, so they can all upload at once
+        plan = plan_chunks(free_space, file_size)
+        fd = os.open(file_path, os.O_RDONLY) if hasattr(os, "pread") else None
+        cancel = threading.Event()
+        pool = bucket_pool(plan)
+        try:
+            futures = [pool.submit(upload_planned_chunk, file_path, fd, offset, chunk_size, bucket, mimetype, file_name, chunk_index, cancel)
+                       for chunk_index, (offset, chunk_size, bucket) in enumerate(plan)]
+            for future in as_completed(futures):
+                if future.result() is None:
+                    raise RuntimeError("Failed to upload chunk")
+        except BaseException:
+            # Stop the other uploads at their next piece instead of letting them run to the end
+            cancel.set()
+            raise
+        finally:
+            # Running uploads still read from fd, so wait for them before closing it
+            pool.shutdown(wait=True, cancel_futures=True)
+            if fd is not None:
+                os.close(fd)
+
+        for chunk_index, ((_, _, bucket), future) in enumerate(zip(plan, futures)):
+            metadata["chunks"].append({
+                "chunk_name": f"{file_name}_part{chunk_index + 1}",
+                "file_id": future.result(),
+                "bucket": bucket
+            })
+
+    append_metadata(metadata)
+    print("Upload complete. Metadata updated.")
+
+def encode_metadata(metadata):
+    if orjson:
+        return orjson.dumps(metadata) + b"\n"
+    return (json.dumps(metadata) + "\n").encode()
+
+def decode_metadata(line):
+    return orjson.loads(line) if orjson else json.loads(line)
+
+def append_metadata(metadata):
+    # One record per line, so an upload only appends instead of rewriting every past record
+    line = encode_metadata(metadata)
+    with open(METADATA_FILE, 'ab') as f:
+        offset = f.tell()
+        f.write(line)
+    # Keep the index current if it covered the file right up to this record; otherwise leave it to rebuild
+    index = read_metadata_index()
+    if index and index["size"] == offset:
+        index["offsets"].setdefault(metadata["file_name"], offset)
+        index["size"] = offset + len(line)
+        write_metadata_index(index)
+
+def read_metadata_index():
+    if not os.path.exists(METADATA_INDEX_FILE):
+        return None
+    with open(METADATA_INDEX_FILE, 'r') as f:
+        try:
+            index = json.load(f)
+        except json.JSONDecodeError:
+            print("Warning: Metadata index is corrupted. Rebuilding.")
+            return None
+    if not isinstance(index, dict) or "size" not in index or "offsets" not in index:
+        return None
+    return index
+
+def write_metadata_index(index):
+    with open(METADATA_INDEX_FILE, 'w') as f:
+        json.dump(index, f)
+
+def build_metadata_index():
+    # Map each file name to the byte offset of its first record, plus the metadata.jsonl size it covers
+    offsets = {}
+    offset = 0
+    with open(METADATA_FILE, 'rb') as f:
+        for line in f:
+            if line.strip():
+                try:
+                    offsets.setdefault(decode_metadata(line).get('file_name'), offset)
+                except ValueError:
+                    print("Warning: Skipping corrupted metadata entry.")
+            offset += len(line)
+    index = {"size": offset, "offsets": offsets}
+    write_metadata_index(index)
+    return index
+
+def load_metadata_index():
+    # metadata.jsonl is append-only, so the index is current exactly when it covers the file's full size
+    index = read_metadata_index()
+    if index and index["size"] == os.path.getsize(METADATA_FILE):
+        return index
+    return build_metadata_index()
+
+def find_metadata(file_name):
+    if not os.path.exists(METADATA_FILE):
+        return None
+    index = load_metadata_index()
+    for attempt in range(2):
+        offset = index["offsets"].get(file_name)
+        if offset is None:
+            return None
+        with open(METADATA_FILE, 'rb') as f:
+            f.seek(offset)
+            line = f.readline()
+        try:
+            record = decode_metadata(line)
+        except ValueError:
+            record = None
+        if isinstance(record, dict) and record.get('file_name') == file_name:
+            return record
+        # The index points at the wrong record; rebuild it from the file and try once more
+        if attempt == 0:
+            print("Warning: Metadata index is out of date. Rebuilding.")
+            index = build_metadata_index()
+    return None
+
+def migrate_metadata():
+    # Convert the old single-list metadata.json into metadata.jsonl once
+    if not os.path.exists(LEGACY_METADATA_FILE) or os.path.exists(METADATA_FILE):
+        return
+    with open(LEGACY_METADATA_FILE, 'r') as f:
+        try:
+            existing_metadata = json.load(f)
+        except json.JSONDecodeError:
+            print("Warning: Legacy metadata file is corrupted. Skipping migration.")
+            return
+    if not isinstance(existing_metadata, list):
+        existing_metadata = [existing_metadata]
+    with open(METADATA_FILE, 'wb') as f:
+        for md in existing_metadata:
+            f.write(encode_metadata(md))
+    print(f"Migrated {len(existing_metadata)} entries to {METADATA_FILE}.")
 
 def download_file(service, file_id, save_path):
     try:
@@ -241,92 +535,120 @@ def download_file(service, file_id, save_path):
         print(f"Download error: {e}")
         return None
 
+def part_index(path):
+    match = re.search(r"_part(\d+)$", os.path.basename(path))
+    return int(match.group(1)) if match else 0
+
 def merge_chunks(file_paths, merged_file_path):
+    # Callers pass parts in order: metadata chunks are stored in upload order, and
+    # bucket search results are sorted by part_index so _part10 follows _part9
     with open(merged_file_path, "wb") as merged_file:
-        for chunk_path in sorted(file_paths):
+        for chunk_path in file_paths:
             with open(chunk_path, "rb") as chunk:
-                merged_file.write(chunk.read())
+                shutil.copyfileobj(chunk, merged_file, length=MIB)
     print(f"Merged file saved at: {merged_file_path}")
 
-def download_using_metadata(file_name, save_path):
-    if not os.path.exists(METADATA_FILE):
-        print("Metadata not found.")
+def download_using_metadata(target_metadata, save_path):
+    file_name = target_metadata['file_name']
+    chunks = target_metadata.get('chunks', [])
+    if not chunks:
+        print("Metadata has no chunks for this file.")
         return
-    with open(METADATA_FILE, 'r') as f:
-        metadata_list = json.load(f)
-    target_metadata = None
-    for md in metadata_list:
-        if md['file_name'] == file_name:
-            target_metadata = md
-            break
-    if not target_metadata:
-        print("File not found in metadata.")
-        return
-    chunks = target_metadata['chunks']
     if len(chunks) == 1 and chunks[0]['chunk_name'] == file_name:
         chunk = chunks[0]
         service = authenticate_account(chunk['bucket'])
         download_file(service, chunk['file_id'], save_path)
         return
-    chunk_paths = []
-    for chunk in chunks:
-        service = authenticate_account(chunk['bucket'])
-        downloaded_path = download_file(service, chunk['file_id'], save_path)
-        if downloaded_path:
-            chunk_paths.append(downloaded_path)
-        else:
-            print("Failed to download chunk.")
-            return
+    # Chunks live in different buckets, so fetch them all at once; map keeps them in chunk order
+    with bucket_pool(chunks) as pool:
+        chunk_paths = list(pool.map(lambda c: download_file(authenticate_account(c['bucket']), c['file_id'], save_path), chunks))
+    if None in chunk_paths:
+        print("Failed to download chunk.")
+        for path in chunk_paths:
+            if path:
+                os.remove(path)
+        return
     merged_path = os.path.join(save_path, file_name)
-    merge_chunks(sorted(chunk_paths), merged_path)
+    merge_chunks(chunk_paths, merged_path)
     for path in chunk_paths:
         os.remove(path)
     print(f"File downloaded: {merged_path}")
 
+def search_bucket(bucket, file_name):
+    # Look for the whole file and its parts in one batched HTTP request
+    service = authenticate_account(bucket)
+    found = {}
+
+    def collect(request_id, response, exception):
+        if exception is not None:
+            raise exception
+        found[request_id] = response.get('files', [])
+
+    batch = service.new_batch_http_request(callback=collect)
+    name = escape_query(file_name)
+    batch.add(service.files().list(q=f"name = '{name}' and trashed=false", fields="files(id, name)"), request_id="files")
+    batch.add(service.files().list(q=f"name contains '{name}_part' and trashed=false", fields="files(id, name)"), request_id="parts")
+    batch.execute()
+    return found.get("files", []), found.get("parts", [])
+
 def download_from_all_buckets(file_name, save_path="downloads"):
     os.makedirs(save_path, exist_ok=True)
-    if os.path.exists(METADATA_FILE):
-        with open(METADATA_FILE, 'r') as f:
-            try:
-                metadata_list = json.load(f)
-                for md in metadata_list:
-                    if md['file_name'] == file_name:
-                        print("Found in metadata. Downloading...")
-                        download_using_metadata(file_name, save_path)
-                        return
-            except json.JSONDecodeError:
-                print("Corrupted metadata.")
+    target_metadata = find_metadata(file_name)
+    if target_metadata:
+        print("Found in metadata. Downloading...")
+        download_using_metadata(target_metadata, save_path)
+        return
     print("Searching all buckets...")
     buckets = get_all_authenticated_buckets()
-    for bucket in buckets:
-        service = authenticate_account(bucket)
-        query = f"name = '{file_name}'"
-        result = service.files().list(q=query).execute()
-        files = result.get('files', [])
-        if files:
-            download_file(service, files[0]['id'], save_path)
-            return
-        query = f"name contains '{file_name}_part'"
-        result = service.files().list(q=query).execute()
-        parts = result.get('files', [])
-        if parts:
-            chunk_paths = []
-            for part in sorted(parts, key=lambda x: x['name']):
-                downloaded = download_file(service, part['id'], save_path)
-                if downloaded:
-                    chunk_paths.append(downloaded)
-            if chunk_paths:
-                merged_path = os.path.join(save_path, file_name)
-                merge_chunks(chunk_paths, merged_path)
-                for path in chunk_paths:
-                    os.remove(path)
-                return
-    print("File not found.")
+    match = None
+    part_matches = {}
+    # No with block: leaving it would wait for the slowest bucket even after an exact match
+    pool = bucket_pool(buckets)
+    try:
+        futures = {pool.submit(search_bucket, bucket, file_name): bucket for bucket in buckets}
+        for future in as_completed(futures):
+            bucket = futures[future]
+            try:
+                files, parts = future.result()
+            except Exception as e:
+                print(f"Error searching bucket {bucket}: {e}")
+                continue
+            # Only an exact name match can stop the search early
+            if files:
+                match = (bucket, files, [])
+                break
+            if parts:
+                part_matches[bucket] = parts
+    finally:
+        # Searches still running use their own bucket's service, so leaving them behind is harmless
+        pool.shutdown(wait=False)
+    if not match and part_matches:
+        # Every bucket has answered; take the first bucket with parts in bucket number order
+        bucket = min(part_matches, key=lambda b: (len(b), b))
+        match = (bucket, [], part_matches[bucket])
+    if not match:
+        print("File not found.")
+        return
+    bucket, files, parts = match
+    service = authenticate_account(bucket)
+    if files:
+        download_file(service, files[0]['id'], save_path)
+        return
+    chunk_paths = []
+    for part in sorted(parts, key=lambda x: part_index(x['name'])):
+        downloaded = download_file(service, part['id'], save_path)
+        if downloaded:
+            chunk_paths.append(downloaded)
+    if chunk_paths:
+        merged_path = os.path.join(save_path, file_name)
+        merge_chunks(chunk_paths, merged_path)
+        for path in chunk_paths:
+            os.remove(path)
 
 def search_files():
     query = input("Enter search keyword: ").strip()
     if query:
-        list_files_from_all_buckets(query=query)
+        list_files_from_all_buckets(query=query, fields_extra=())
 
 def add_new_bucket():
     bucket_number = len(get_all_authenticated_buckets()) + 1
@@ -335,6 +657,7 @@ def add_new_bucket():
 
 if __name__ == "__main__":
     print("Syncly Demo 1")
+    migrate_metadata()
     while True:
         print("\n----- Storage Summary -----")
         check_all_storage()